@@ -4,11 +4,13 @@ diffable.py
 Support for objects that can report their differences.
 """
 
+from utils import VISIBLE_SPACES
+
 def show_spaces(string):
   """
   Returns a string with whitespace made visible. Newlines are preserved.
   """
-  return string.replace(' ', '␣').replace('\t', '␉').replace('\r', '␍')
+  return string.translate(VISIBLE_SPACES)
 
 def strdiff(a, b):
   """
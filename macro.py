@@ -6,32 +6,264 @@ See modules/help.fls for a description of the macro system.
 
 import re
 import sys
-import copy
+import inspect
 import traceback
 
 import utils
 
 import ops
 
-MACRO_START = re.compile(r"\(([a-zA-Z_][a-zA-Z_0-9.]+)~")
-
-INT_CONSTANT = re.compile(r"([+-])?(0[xo])?([0-9A-Fa-f])+")
+from state import StoryState, copy_state
+
+MACRO_START = re.compile(r"\(([a-zA-Z_][a-zA-Z_0-9.]*)~")
+
+# Master pattern for lex_expr: each alternative is named for the kind of token
+# it finds, and exactly one alternative matches at any position (words take
+# whatever the other alternatives don't).
+TOKEN = re.compile(
+  r"""
+    (?P<space>\s+)
+  | (?P<call>\([a-zA-Z_][a-zA-Z_0-9.]*~)
+  | (?P<string>`)
+  | (?P<hex>0x[0-9A-Fa-f]+)
+  | (?P<oct>0o[0-7]+)
+  | (?P<float>[0-9]+(?:\.[0-9]+)?[eE][+-]?[0-9]+|[0-9]+\.[0-9]+)
+  | (?P<int>[0-9]+)
+  | (?P<op>\*\*|//|%%|\^\^|<=|>=|!=|==?|[-+%&|./*^<>!])
+  | (?P<open>[(\[])
+  | (?P<close>[)\]])
+  | (?P<word>["']?[^\s()\[\]+\-%&|./*^=<>!"'`]*)
+  """,
+  re.VERBOSE
+)
 
-FLOAT_CONSTANT = re.compile(r"([+-])?([0-9]+)(\.[0-9]*)?([eE][+-]?[0-9]+)?")
+# Shared units for lex_expr to emit for fixed tokens, keyed by token text:
+# ('[' is in ops.OPCODES but lexes as an index unit, which parse_next_op turns
+# into the index operator.)
+FIXED_UNITS = { o: ("op", c) for o, c in ops.OPCODES.items() }
+FIXED_UNITS.update({
+  '(': ("group", "open"),
+  ')': ("group", "close"),
+  '[': ("index", "open"),
+  ']': ("index", "close"),
+  '==': FIXED_UNITS['='], # allow '==' with same meaning as '='
+})
+
+# Unit types that parse_next_val turns directly into values:
+VALUE_UNITS = ("word", "call", "int", "float", "string")
+
+# Opcodes of operators that always parse as plain binary operators (the rest
+# are unary, take extra operands, or need special handling in parse_units):
+BINARY_OPCODES = frozenset(
+  ops.OPCODES[o]
+    for o in ops.OPERATORS
+    if o not in ('[', '.', '%', '%%', '|', '!', 'not')
+)
 
 BUILTINS = {}
 
+# Maps newlines, carriage returns, and tabs to visible symbols for warnings:
+CONTROL_PICTURES = str.maketrans({
+  '\n': '\u2424',
+  '\r': '\u240d',
+  '\t': '\u2409',
+})
+
+# Maximum number of distinct texts whose scan_text results are remembered:
+SCAN_CACHE_SIZE = 1024
+
+# Maps text to its scan_text result:
+_SCAN_CACHE = {}
+
+# Maximum number of distinct expressions whose parse trees are remembered:
+PARSE_CACHE_SIZE = 4096
+
+# Maps expressions to their parse trees:
+_PARSE_CACHE = {}
+
+# Maps expressions to their compiled code (see compile_expr):
+_CODE_CACHE = {}
+
+# Instructions for compiled expressions (see compile_tree and run_code):
+INS_PUSH = 0 # push a constant
+INS_LOAD = 1 # push the value of a variable
+INS_CALL = 2 # push the result of a macro call
+INS_APPLY = 3 # replace the top n values with the result of an operator
+INS_OR = 4 # if the top value is true, replace it with True and jump
+INS_AND = 5 # if the top value is false, replace it with False and jump
+INS_BOOL = 6 # replace the top value with its truth value
+INS_MAP = 7 # replace the top value with the results of mapping code over it
+
+# Types of values which can't be modified in place, so that a single cached
+# value can safely be handed out to every later evaluation:
+IMMUTABLE_TYPES = (str, int, float, bool, type(None), tuple)
+
+# Builtins whose results depend only on their arguments when those arguments
+# are constant (see constant_arg):
+PURE_BUILTINS = frozenset(["eval", "text", "if", "select", "lookup"])
+
+# Maximum number of distinct builtin calls whose results are remembered:
+MACRO_CACHE_SIZE = 1024
+
+# Maps (name, args) of builtin calls to 1-tuples holding their results, or to
+# IMPURE for calls which can't be cached:
+_MACRO_CACHE = {}
+IMPURE = "impure"
+
+# Context lists of the eval_text calls currently in progress, innermost last.
+# The 'context' builtin and the _context variable read from the top entry.
+_CTX_STACK = []
+
 def mb(f):
   """
-  Decorator for registering builtins.
+  Decorator for registering builtins. Also records the builtin's accepted
+  range of argument counts as f.arity, a (minimum, maximum) pair where the
+  maximum is None for builtins that take any number of arguments. Builtins
+  take (module_finder, story, state) before their macro arguments.
   """
   global BUILTINS
   fn = f.__name__
   if fn.endswith('_'):
     fn = fn[:-1]
-  BUILTINS[fn] = f
+  code = f.__code__
+  n_args = code.co_argcount - 3
+  f.arity = (
+    n_args - len(f.__defaults__ or ()),
+    None if code.co_flags & inspect.CO_VARARGS else n_args
+  )
+  BUILTINS[sys.intern(fn)] = f
   return f
 
+def find_macro_start(text, start=0):
+  """
+  Returns a match object for the first MACRO_START at or after the given index
+  in the given text, or None if there isn't one. Uses str.find to jump between
+  candidate open-parens instead of having the regex engine step through every
+  character, which matters for long stretches of macro-free text.
+
+  Examples:
+    ```?
+    find_macro_start("plain (text) then (set~ x ~ 1)").start()
+    ```=
+    18
+    ```?
+    find_macro_start("(set~ x ~ 1) and (add~ x ~ 1)", 1).group(1)
+    ```=
+    "add"
+    ```?
+    find_macro_start("one-letter (f~ 1) names").group(1)
+    ```=
+    "f"
+    ```>
+    find_macro_start("no (macros) here") is None
+    ```
+  """
+  i = text.find('(', start)
+  while i >= 0:
+    m = MACRO_START.match(text, i)
+    if m:
+      return m
+    i = text.find('(', i + 1)
+  return None
+
+def scan_text(text):
+  """
+  Splits text into segments for eval_text, returning a tuple of
+  (literal-text, macro-name, macro-arguments) triples in which the literal text
+  precedes the macro call and the arguments are a tuple of strings (see
+  split_macro_args). The final triple holds any trailing text and has None for
+  its name and arguments. The scan only depends on the text, so results are
+  cached (up to SCAN_CACHE_SIZE distinct texts) and node content that is
+  displayed many times is only scanned and split once.
+
+  Examples:
+    ```?
+    scan_text("a (f~ x) b")
+    ```=
+    (("a ", "f", (" x",)), (" b", None, None))
+    ```?
+    scan_text("plain")
+    ```=
+    (("plain", None, None),)
+    ```
+  """
+  if '~' not in text: # every macro start includes a tilde
+    return ((text, None, None),)
+
+  if text in _SCAN_CACHE:
+    return _SCAN_CACHE[text]
+
+  i = 0 # start of text not yet part of a segment
+  segments = []
+  # Find every candidate macro start in one pass, skipping those that turn out
+  # to be nested inside an earlier macro:
+  for ms in MACRO_START.finditer(text):
+    start = ms.start()
+    if start < i:
+      continue
+    try:
+      # (as in lex_expr, start from the '~' to skip rescanning the name)
+      end = utils.matching_brace(text, ms.end() - 1, '(', ')')
+    except utils.UnmatchedError as e:
+      ectx = text[max(0, start-10):start+50].translate(CONTROL_PICTURES)
+      eii = min(start, 10)
+      print(
+        (
+          "Warning: Unclosed macro treated as text as position {} in:"
+          "\n{}\n{}"
+        ).format(
+          start,
+          ectx,
+          ' '*eii + '^' + ' '*(60 - eii - 1)
+        ),
+        file=sys.stderr
+      )
+      continue # keep the unclosed macro as text
+
+    # start and end found -> record text before macro along with the macro:
+    # (names are interned so that macro lookups can compare by identity)
+    segments.append(
+      (
+        text[i:start],
+        sys.intern(ms.group(1)),
+        tuple(split_macro_args(text[ms.end():end]))
+      )
+    )
+    i = end + 1
+
+  segments.append((text[i:], None, None))
+  segments = tuple(segments)
+
+  if len(_SCAN_CACHE) >= SCAN_CACHE_SIZE:
+    # forget the oldest entry
+    del _SCAN_CACHE[next(iter(_SCAN_CACHE))]
+  _SCAN_CACHE[text] = segments
+
+  return segments
+
+def constant_arg(arg):
+  """
+  Whether the given macro argument is constant: whether it's evaluated as an
+  expression or as text, it contains no macro calls or variable names, and so
+  can neither read nor change the story state.
+
+  Examples:
+    ```>
+    constant_arg("1 + `two`")
+    ```>
+    not constant_arg("x + 1")
+    ```>
+    not constant_arg("(set~ x ~ 1)")
+    ```
+  """
+  if find_macro_start(arg) is not None:
+    return False
+  try:
+    units = lex_expr(arg)
+  except Exception:
+    return False
+  return all(typ != "word" and typ != "call" for typ, val in units)
+
 def split_macro_args(content):
   """
   Splits macro content into different arguments, respecting quoted strings and
@@ -42,16 +274,19 @@ def split_macro_args(content):
   # First, find quoted regions:
   qrs = list(utils.find_quoted_regions(content, qc='`').keys())
 
-  # Next, find macro calls:
+  # Next, find macro calls (q is the first quoted region that might still
+  # include a macro start, since starts are found in order):
   mrs = []
+  q = 0
   i = 0
   while i < len(content):
     # Look for a macro-start:
-    m = MACRO_START.search(content, i)
+    m = find_macro_start(content, i)
     if m:
-      r = utils.find_region(qrs, m.start())
-      if r:
-        i = r[1]+1 # skip to end of quoted region
+      while q < len(qrs) and qrs[q][1] < m.start():
+        q += 1
+      if q < len(qrs) and qrs[q][0] <= m.start():
+        i = qrs[q][1]+1 # skip to end of quoted region
         continue
 
       # Otherwise this 
@@ -69,24 +304,30 @@ def split_macro_args(content):
   # Combine macro- and quote-excluded regions:
   exrs = sorted(qrs + mrs)
 
-  # Finally, find non-excluded delimiters:
+  # Finally, find non-excluded delimiters, sweeping through the regions in
+  # step with the delimiters (k is the first region that might still matter):
   result = []
+  # (bound to locals to skip attribute lookups in the loop)
+  find = content.find
+  n = len(content)
+  k = 0
   i = 0
-  while i < len(content):
-    # Compute first-non-excluded-delimiter index:
-    try:
-      di = content.index('~', i)
-    except ValueError:
-      di = len(content)
-
-    for exr in exrs:
-      if di >= len(content):
+  while i < n:
+    di = find('~', i)
+    if di == -1:
+      di = n
+
+    while di < n and k < len(exrs):
+      start, end = exrs[k]
+      if end < di: # region is behind us
+        k += 1
+      elif start <= di: # delimiter is excluded; look past the region
+        di = find('~', end+1)
+        if di == -1:
+          di = n
+        k += 1
+      else: # region is ahead of us
         break
-      if exr[0] <= di and exr[1]>= di:
-        try:
-          di = content.index('~', exr[1]+1)
-        except ValueError:
-          di = len(content)
 
     result.append(content[i:di])
     i = di + 1
@@ -95,129 +336,80 @@ def split_macro_args(content):
 
 def to_string(value):
   """
+  Converts a macro result into text. Strings are returned as-is.
+
   TODO: Something more complicated here?
   """
+  if type(value) is str:
+    return value
   return str(value)
 
 def lex_expr(expr):
   """
-  Lexes an expression into syntax units.
+  Lexes an expression into syntax units. Operator units carry integer opcodes
+  (see ops.OPCODES) rather than operator strings. Each token is found by a
+  single match of the TOKEN pattern.
+
+  Examples:
+    ```?
+    lex_expr("x + 0x1f*2.5 and `hi`")
+    ```=
+    [
+      ("word", "x"),
+      ("op", ops.OP_PLUS),
+      ("int", 31),
+      ("op", ops.OPCODES['*']),
+      ("float", 2.5),
+      ("op", ops.OP_AND),
+      ("string", "hi"),
+    ]
+    ```?
+    lex_expr("(f~ 1)[0]")
+    ```=
+    [("call", "(f~ 1)"), ("index", "open"), ("int", 0), ("index", "close")]
+    ```
   """
-  i = -1
-  sval = None
+  i = 0
   units = []
-  while i < len(expr)-1:
-    i += 1
-    c = expr[i]
-
-    # Check for end-of-word with accumulated string value:
-    if c in "()[]+-%&|./*^=<>!\"'" and sval != None:
-      units.append(("word", sval))
-      sval = None
-
-    if c in ' \n\r\t': # (separate if statement)
-      if sval:
-        units.append(("word", sval))
-        sval = None
-    elif c == '(':
-      m = MACRO_START.search(expr, i)
-      start = m.start()
-      if start == i:
-        end = utils.matching_brace(expr, i, '(', ')')
-        units.append(("call", expr[start:end+1]))
-        i = end
-      else:
-        units.append("group", "open")
-    elif c == ')':
-      units.append("group", "close")
-    elif c == '[':
-      units.append("index", "open")
-    elif c == ']':
-      units.append("index", "close")
-    elif c in "+-&|.":
-      units.append(("op", c))
-    elif c in "/*%^":
-      if expr[i+1] == c:
-        units.append(("op", c+c))
-        i += 1
-      else:
-        units.append(("op", c))
-    elif c == '=':
-      if expr[i+1] == c: # allow '==' with same meaning as '='
-        i += 1
-      units.append(("op", c))
-    elif c in '<>!':
-      if expr[i+1] == '=':
-        units.append(("op", expr[i:i+2]))
-        i += 1
-      else:
-        units.append(("op", c))
-    elif c == 'a' and expr[i:i+3] == 'and':
-      if sval != None:
-        sval += "and"
+  # (bound to locals to skip attribute lookups in the loop)
+  append = units.append
+  match_token = TOKEN.match
+  fixed = FIXED_UNITS
+  while i < len(expr):
+    m = match_token(expr, i)
+    kind = m.lastgroup
+    i = m.end()
+
+    if kind == "space":
+      pass
+    elif kind == "word":
+      word = m.group()
+      if word in fixed: # 'and', 'or', or 'not'
+        append(fixed[word])
       else:
-        units.append(("op", "and"))
-      i += 2
-    elif c == 'o' and expr[i:i+2] == 'or':
-      if sval != None:
-        sval += "or"
-      else:
-        units.append(("op", "or"))
-      i += 1
-    elif c == 'n' and expr[i:i+3] == 'not':
-      if sval != None:
-        sval += "not"
-      else:
-        units.append(("op", "not"))
-      i += 2
-    elif c in "0123456789":
-      if sval != None:
-        sval += c
-      else:
-        m = INT_CONSTANT.match(expr, i)
-        if m:
-          try:
-            if m.group(2) == "0x":
-              it = int(m.group(0), 16)
-            elif m.group(2) == "0o":
-              it = int(m.group(0), 8)
-            else:
-              it = int(m.group(0), 10)
-            i = m.end()
-            units.append(("int", it))
-            continue
-          except ValueError:
-            pass
-        m = FLOAT_CONSTANT.match(expr, i)
-        if m:
-          try:
-            f = float(m.group(0))
-            i = m.end()
-            units.append(("float", f))
-            continue
-          except ValueError:
-            pass
-        # Not recognized as a number: treat as a string.
-        if sval is None:
-          sval = c
-        else:
-          sval += c
-    elif c == '`':
-      ei, qc = utils.string_literal(expr, i, qc=c)
-      units.append(("string", qc))
-      i = ei
-    else: # Not a recognized operator: add to string
-      # TODO: Add sval as a unit somewhere?
-      if sval is None:
-        sval = c
-      else:
-        sval += c
-
-  if sval:
-    units.append(("word", sval))
-    sval = None
+        append(("word", sys.intern(word)))
+    elif kind == "op" or kind == "open" or kind == "close":
+      append(fixed[m.group()])
+    elif kind == "int":
+      append(("int", int(m.group())))
+    elif kind == "float":
+      append(("float", float(m.group())))
+    elif kind == "hex":
+      append(("int", int(m.group(), 16)))
+    elif kind == "oct":
+      append(("int", int(m.group(), 8)))
+    elif kind == "call":
+      # (the macro name can't contain braces or quotes, so the search for the
+      # closing paren can start from the '~' instead of rescanning the name;
+      # arguments quote strings with backticks)
+      end = utils.matching_brace(expr, m.end() - 1, '(', ')', qc='`')
+      append(("call", expr[m.start():end+1]))
+      i = end + 1
+    else: # kind == "string"
+      ei, sv = utils.string_literal(expr, m.start(), qc='`')
+      append(("string", sv))
+      i = ei + 1
 
-  # After the dust settles:
   return units
 
 class ParseError(Exception):
@@ -249,43 +441,118 @@ class FunctionCall(ParseUnit):
     self.name = name
     self.args = args
 
-def parse_next_val(units):
+class ParseNode:
+  """
+  A node in an expression parse tree (see parse_units). Value nodes have op
+  "value" (or "opval" for an operator used as a value) and hold a constant,
+  VariableLookup, FunctionCall, or ops.Operator as their value; other nodes
+  hold an operator string as their op along with a list of argument nodes.
+  The state, parent, and code attributes are used during parsing. Use to_dict
+  to get a plain-dictionary version of a finished tree.
+  """
+  __slots__ = (
+    "state",
+    "op",
+    "code",
+    "grouped",
+    "arity",
+    "args",
+    "value",
+    "parent",
+  )
+
+  def __init__(
+    self,
+    state,
+    op=None,
+    code=None,
+    grouped=False,
+    arity=None,
+    args=None,
+    value=None,
+    parent=None
+  ):
+    self.state = state
+    self.op = op
+    self.code = code
+    self.grouped = grouped
+    self.arity = arity
+    self.args = [] if args is None else args
+    self.value = value
+    self.parent = parent
+
+  def to_dict(self):
+    """
+    Returns a dictionary version of this node and its arguments (omitting
+    parsing-only information).
+    """
+    if self.op in ("value", "opval"):
+      return { "state": self.state, "op": self.op, "value": self.value }
+    return {
+      "state": self.state,
+      "grouped": self.grouped,
+      "op": self.op,
+      "arity": self.arity,
+      "args": [ a.to_dict() for a in self.args ]
+    }
+
+def match_groups(units):
   """
-  Parses the next value from the given units. Returns a (parse-tree, leftovers)
-  pair.
+  Returns a dictionary mapping the index of each opening group or index unit
+  in the given list of units to the index of its matching closing unit. Builds
+  the whole mapping in one pass, so the parser never has to scan for closing
+  units. Raises a ParseError if the units aren't balanced.
+
+  Example:
+    ```?
+    match_groups(lex_expr("(1 + (2)) * x[3]"))
+    ```=
+    { 0: 6, 3: 5, 9: 11 }
+    ```
+  """
+  matches = {}
+  stack = []
+  for i, (ut, uv) in enumerate(units):
+    if ut == "group" or ut == "index":
+      if uv == "open":
+        stack.append(i)
+      elif stack and units[stack[-1]][0] == ut:
+        matches[stack.pop()] = i
+      else:
+        raise ParseError(
+          "Unmatched '{}'.".format(')' if ut == "group" else ']')
+        )
+
+  if stack:
+    raise ParseError(
+      "Unmatched '{}'.".format('(' if units[stack[-1]][0] == "group" else '[')
+    )
+
+  return matches
+
+def parse_next_val(units, i=0, matches=None):
   """
-  ut, uv = units[0]
+  Parses the value starting at index i of the given units. Returns a
+  (parse-tree, next-index) pair. The matches argument should be the result of
+  match_groups for the units; it will be computed if not given.
+  """
+  ut, uv = units[i]
   if ut == "word":
     if uv == "True":
-      return True, units[1:]
+      return True, i+1
     elif uv == "False":
-      return False, units[1:]
+      return False, i+1
     elif uv == "None":
-      return None, units[1:]
+      return None, i+1
     else:
-      return VariableLookup(uv), units[1:]
+      return VariableLookup(uv), i+1
   elif ut == "group":
-    subunits = []
-    level = 0
-    for i in range(1, len(units)):
-      sut, suv = units[i]
-      if sut == "group":
-        if suv == "open":
-          level += 1
-          subunits.append((sut, suv))
-        elif suv == "close":
-          level -= 1
-          if level < 0:
-            break
-          else:
-            subunits.append((sut, suv))
-        else:
-          raise RuntimeError("Invalid lex unit 'group' value '{}'.".format(suv))
-      else:
-        subunits.append((sut, suv))
-    if level >= 0:
-      raise ParseError("Unmatched '('.")
-    return parse_units(subunits), units[i+1:]
+    if uv != "open":
+      raise ParseError("Unexpected ')' (expected value).")
+    if matches is None:
+      matches = match_groups(units)
+    close = matches[i]
+    return parse_units(units, start=i+1, end=close, matches=matches), close+1
   elif ut == "index":
     raise ParseError("Unexpected index (expected value).")
   elif ut == "call":
@@ -293,46 +560,45 @@ def parse_next_val(units):
     if not ms:
       raise ParseError("Invalid macro token.")
     macro_name = ms.group(1)
-    macro_content = uv[ms.end():]
+    macro_content = uv[ms.end():-1] # (call units include the closing paren)
     macro_args = split_macro_args(macro_content)
-    return FunctionCall(macro_name, macro_args), units[1:]
+    return FunctionCall(macro_name, macro_args), i+1
   elif ut == "op":
     raise ParseError("Unexpected operator (expected value).")
   elif ut in ("int", "float", "string"):
-    return uv, units[1:]
+    return uv, i+1
 
-def parse_next_op(units):
+def parse_next_op(units, i=0):
   """
-  Parses the next operator from the units. Returns a (parse-tree, leftovers)
-  pair
+  Parses the operator at index i of the given units. Returns an
+  (ops.Operator, next-index) pair.
   """
-  ut, uv = units[0]
+  ut, uv = units[i]
   if ut == "word":
     raise ParseError("Unexpected variable (expected operator).")
   elif ut == "group":
     raise ParseError("Unexpected group (expected operator).")
   elif ut == "index":
     if uv == "open":
-      return ops.Operator('['), units[1:]
+      return ops.Operator(ops.OP_INDEX), i+1
     else:
       raise ParseError("Unexpected index end (expected operator).")
   elif ut == "call":
     raise ParseError("Unexpected call (expected operator).")
   elif ut == "op":
-    return ops.Operator(uv), units[1:]
+    return ops.Operator(uv), i+1
   elif ut in ("int", "float", "string"):
     raise ParseError("Unexpected constant (expected operator).")
 
 def scrub_parents(result):
   """
-  Scrubs parent entries from a parse tree to make it serializable.
+  Clears the parent links that parse_units uses internally from a parse tree,
+  so that finished trees don't contain reference cycles.
   """
-  if "parent" in result:
-    del result["parent"]
-  if "args" in result:
-    for arg in result["args"]:
-      if isinstance(arg, dict):
-        scrub_parents(arg)
+  result.parent = None
+  for arg in result.args:
+    if isinstance(arg, ParseNode):
+      scrub_parents(arg)
 
   return result
 
@@ -341,59 +607,58 @@ def escape_upwards(result):
   Escapes upward during parsing, creating a new potential binop context if
   necessary.
   """
-  while result["parent"] != None and result["state"] == "complete":
-    result = result["parent"]
-  if result["state"] == "complete":
-    result["parent"] = {
-      "parent": None,
-      "state": "need_op",
-      "grouped": False,
-      "op": None,
-      "arity": None,
-      "args": [result]
-    }
-    return result["parent"]
+  while result.parent != None and result.state == "complete":
+    result = result.parent
+  if result.state == "complete":
+    result.parent = ParseNode("need_op", args=[result])
+    return result.parent
   else:
     return result
 
 def rotate_operators(result, new_op):
   """
-  Checks if the given new operation should result in a rotated tree due to
-  operator precedence, and if so, returns the appropriately-rotated tree.
-  If not, it returns None. Note that this function assumes that the operator is
-  a standard binary operator, adjustments to arity and/or state for other
-  operators must be made separately.
+  Checks if the given new operation (an ops.Operator) should result in a
+  rotated tree due to operator precedence, and if so, returns the
+  appropriately-rotated tree. If not, it returns None. Note that this function
+  assumes that the operator is a standard binary operator, adjustments to arity
+  and/or state for other operators must be made separately.
   """
-  if len(result["args"]) == 0:
+  if len(result.args) == 0:
     return None
 
-  target = result["args"][-1]
-  top = target["op"]
-  if (
-    not target.get("grouped", False)
-and top not in ("value", "opval")
-  ):
-    lpr = ops.OPERATOR_PRECEDENCE[top]
-    hpr = ops.OPERATOR_PRECEDENCE[new_op]
+  target = result.args[-1]
+  if not target.grouped and target.op not in ("value", "opval"):
+    lpr = ops.PRECEDENCE[target.code]
+    hpr = ops.PRECEDENCE[new_op.code]
     if hpr > lpr:
       # Need to swap structure due to operator binding:
-      nr = {
-        "parent": target,
-        "state": "need_val",
-        "grouped": False,
-        "op": new_op,
-        "arity": 2,
-        "args": [ target["args"][-1] ]
-      }
+      nr = ParseNode(
+        "need_val",
+        new_op.op,
+        code=new_op.code,
+        arity=2,
+        args=[ target.args[-1] ],
+        parent=target
+      )
       # Note: Arity/state for special operators must be fixed separately!
       # Supplant previous RHS:
-      target["args"][-1] = nr
+      target.args[-1] = nr
       # Return new subtree:
       return nr
 
   return None
 
-def parse_units(units, ungrouped=False):
+def value_node(val, parent):
+  """
+  Wraps a value from parse_next_val as a complete parse-tree node with the
+  given parent. Parse trees (from parenthesized groups) are used directly.
+  """
+  if isinstance(val, ParseNode):
+    val.parent = parent
+    return val
+  return ParseNode("complete", "value", value=val, parent=parent)
+
+def parse_units(units, ungrouped=False, start=0, end=None, matches=None):
   """
   Parses lexed macro units into an expression parse tree. Unit types (see
   lex_expr):
@@ -406,188 +671,205 @@ def parse_units(units, ungrouped=False):
 
   Unless 'ungrouped' is given, the resulting parse tree is treated as a grouped
   tree (further parsing won't edit it for order-of-operations purposes).
+
+  Only the units from index start up to (but not including) index end are
+  parsed. Groups and indices are found using the given matches (see
+  match_groups), which will be computed if not given.
   """
-  result = {
-    "parent": None,
-    "state": "blank",
-    "grouped": False,
-    "op": None,
-    "arity": None,
-    "args": []
-  }
-  rest = units
-  while rest:
-    if result["state"] == "complete":
+  if end is None:
+    end = len(units)
+
+  # A lone value (as in most groups and indices) needs no operator handling:
+  if end - start == 1 and units[start][0] in VALUE_UNITS:
+    val, _ = parse_next_val(units, start)
+    return ParseNode("complete", "value", value=val)
+
+  if matches is None:
+    matches = match_groups(units)
+
+  result = ParseNode("blank")
+  i = start
+  while i < end:
+    if result.state == "complete":
       result = escape_upwards(result)
       # and keep parsing here
-    elif result["state"] == "blank":
+    elif result.state == "blank":
       try:
-        val, rest = parse_next_val(rest)
-        result["args"].append(
-          {
-            "parent": result,
-            "state": "complete",
-            "op": "value",
-            "value": val
-          }
-        )
-        result["state"] = "need_op"
+        val, i = parse_next_val(units, i, matches)
+        result.args.append(value_node(val, result))
+        result.state = "need_op"
       except ParseError as e:
-        (otyp, op), rest = parse_next_op(rest)
-        if op in ['+', '-', 'not']: # unary operators
-          result["arity"] = 1
-          result["op"] = op
-          result["state"] = "need_val"
+        op, i = parse_next_op(units, i)
+        if op.code in ops.UNARY_OPCODES: # unary operators
+          result.arity = 1
+          result.op = op.op
+          result.code = op.code
+          result.state = "need_val"
         else:
           raise e
-    elif result["state"] == "need_val":
-      backup = rest
+    elif result.state == "need_val":
+      backup = i
       try:
-        val, rest = parse_next_val(rest)
-        result["args"].append(
-          {
-            "parent": result,
-            "state": "complete",
-            "op": "value",
-            "value": val
-          }
-        )
-        if len(result["args"]) == result["arity"]:
-          result["state"] = "complete"
+        val, i = parse_next_val(units, i, matches)
+        result.args.append(value_node(val, result))
+        if len(result.args) == result.arity:
+          result.state = "complete"
         # else state stays as need_val
       except ParseError as e:
-        op, rest = parse_next_op(rest)
-        if op.op in ['+', '-', 'not']: # stacked unary
-          nr = {
-            "parent": result,
-            "state": "need_val",
-            "grouped": False,
-            "op": op.op,
-            "arity": 1,
-            "args": []
-          }
-          result["args"].append(nr)
+        op, i = parse_next_op(units, i)
+        if op.code in ops.UNARY_OPCODES: # stacked unary
+          nr = ParseNode(
+            "need_val",
+            op.op,
+            code=op.code,
+            arity=1,
+            parent=result
+          )
+          result.args.append(nr)
           result = nr # shift down into lower context
         elif (
-          result["op"] == '.'
-      and result["arity"] == 3
-      and len(result["args"]) == 2
+          result.op == '.'
+      and result.arity == 3
+      and len(result.args) == 2
         ):
-          # revise our arity estimate and reset rest:
-          result["arity"] = 2
-          result["complete"] = True
-          rest = backup
+          # revise our arity estimate and back up:
+          result.arity = 2
+          result.state = "complete"
+          i = backup
         else:
           raise e
-    elif result["state"] == "need_op":
-      op, rest = parse_next_op(rest)
-      if op.op == 'not': # unary operator
-        raise ParseError("Expected binary operator but got '{}'.".format(op))
-      elif op.op == '[': # recurse to get index parse tree
-        rr = rotate_operators(result, op.op)
+    elif result.state == "need_op":
+      op, i = parse_next_op(units, i)
+      if op.code == ops.OP_NOT: # unary operator
+        raise ParseError(
+          "Expected binary operator but got '{}'.".format(op.op)
+        )
+      elif op.code == ops.OP_INDEX: # recurse to get index parse tree
+        rr = rotate_operators(result, op)
         if rr:
           result = rr
         # else no change
-        level = 0
-        for i in range(1, len(rest)):
-          if rest[i] == ("index", "open"):
-            level += 1
-          elif rest[i] == ("index", "close"):
-            level -= 1
-            if level < 0:
-              break
-        if level >= 0:
-          raise ParseError("Unmatched '['.")
-        result["arity"] = 2
-        result["op"] = op.op
-        result["state"] = "complete"
-        result["args"].append(parse_units(rest[1:i]))
-        rest = rest[i+1:]
+        close = matches[i-1]
+        result.arity = 2
+        result.op = op.op
+        result.code = op.code
+        result.state = "complete"
+        index = parse_units(units, start=i, end=close, matches=matches)
+        index.parent = result
+        result.args.append(index)
+        i = close + 1
       else: # a binary (or possibly trinary) operator
-        rr = rotate_operators(result, op.op)
+        rr = rotate_operators(result, op)
         if rr:
           result = rr
         else:
-          result["arity"] = 2
-          result["op"] = op.op
-          result["state"] = "need_val"
+          result.arity = 2
+          result.op = op.op
+          result.code = op.code
+          result.state = "need_val"
 
         # Fix arity/state for special operators:
-        if op.op in ('%', '%%', '.'):
-          result["arity"] = 3
-        elif op.op == '|':
-          result["arity"] = 3
-          result["state"] = "need_opval"
-        elif op.op == '!':
-          result["state"] = "need_call"
-
-    elif result["state"] == "need_opval":
-      op, rest = parse_next_op(rest)
-      result["args"].append(
-        {
-          "parent": result,
-          "state": "complete",
-          "op": "opval",
-          "value": op
-        }
+        if op.code in (ops.OP_MOD, ops.OP_REPLACE, ops.OP_DOT):
+          result.arity = 3
+        elif op.code == ops.OP_PIPE:
+          result.arity = 3
+          result.state = "need_opval"
+        elif op.code == ops.OP_MAP:
+          result.state = "need_call"
+
+    elif result.state == "need_opval":
+      op, i = parse_next_op(units, i)
+      result.args.append(
+        ParseNode("complete", "opval", value=op, parent=result)
       )
-      result["state"] = "need_val"
-    elif result["state"] == "need_call":
-      val, rest = parse_next_val(rest)
+      result.state = "need_val"
+    elif result.state == "need_call":
+      val, i = parse_next_val(units, i, matches)
       if isinstance(val, FunctionCall):
-        result["args"].append(
-          {
-            "parent": result,
-            "state": "complete",
-            "op": "value",
-            "value": val
-          }
-        )
-        if len(result["args"]) == result["arity"]:
-          result["state"] = "complete"
+        result.args.append(value_node(val, result))
+        if len(result.args) == result.arity:
+          result.state = "complete"
         else:
-          result["state"] = "need_val"
+          result.state = "need_val"
       else:
         raise ParseError("Didn't find required macro call.")
 
   # No more leftovers
 
-  if result["state"] == "complete":
+  if result.state == "complete":
     pass
-  elif result["state"] == "need_op":
+  elif result.state == "need_op":
     if (
-      result["parent"] != None
-   or result["op"] != None
-   or result["arity"] != None
+      result.parent != None
+   or result.op != None
+   or result.arity != None
     ):
       raise ParseError("Ended parsing with leftover expectations.")
   else:
-    raise ParseError("Ended parsing in state '{}'.".format(result["state"]))
+    raise ParseError("Ended parsing in state '{}'.".format(result.state))
 
   result = escape_upwards(result)
   if (
-    result["state"] != "need_op"
- or result["parent"] != None
- or result["op"] != None
- or result["arity"] != None
+    result.state != "need_op"
+ or result.parent != None
+ or result.op != None
+ or result.arity != None
   ):
     raise ParseError("Ended parsing with leftover expectations.")
 
-  result = result["args"][0]
-  result["parent"] = None
+  result = result.args[0]
+  result.parent = None
 
-  if not ungrouped and result["op"] not in ("value", "opval"):
-    result["grouped"] = True
+  if not ungrouped and result.op not in ("value", "opval"):
+    result.grouped = True
 
   return result
 
+def parse_simple_units(units):
+  """
+  Handles the common cases of a lone value or a single binary operator between
+  two values without running the full precedence machinery of parse_units.
+  Returns the same (scrubbed) parse tree that parse_units would, or None if the
+  units aren't that simple.
+  """
+  if len(units) == 1:
+    if units[0][0] not in VALUE_UNITS:
+      return None
+    val, _ = parse_next_val(units)
+    return ParseNode("complete", "value", value=val)
+  elif len(units) == 3:
+    (lt, _), (ot, ov), (rt, _) = units
+    if (
+      ot != "op"
+   or ov not in BINARY_OPCODES
+   or lt not in VALUE_UNITS
+   or rt not in VALUE_UNITS
+    ):
+      return None
+    lhs, _ = parse_next_val(units, 0)
+    rhs, _ = parse_next_val(units, 2)
+    return ParseNode(
+      "complete",
+      ops.OPERATORS[ov],
+      code=ov,
+      grouped=True,
+      arity=2,
+      args=[
+        ParseNode("complete", "value", value=lhs),
+        ParseNode("complete", "value", value=rhs)
+      ]
+    )
+  return None
+
 def parse_expr(expr):
   """
-  Parses a macro expression into a parse tree of operations.
+  Parses a macro expression into a parse tree of operations. Parse trees are
+  cached by expression (up to PARSE_CACHE_SIZE of them), so the same tree may
+  be returned more than once and must not be modified.
 
   Examples:
     ```?
-    parse_expr("`yes`")
+    parse_expr("`yes`").to_dict()
     ```=
     {
       "state": "complete",
@@ -595,7 +877,7 @@ def parse_expr(expr):
       "value": "yes"
     }
     ```?
-    parse_expr("True")
+    parse_expr("True").to_dict()
     ```=
     {
       "state": "complete",
@@ -603,7 +885,7 @@ def parse_expr(expr):
       "value": True
     }
     ```?
-    parse_expr("1 + 2")
+    parse_expr("1 + 2").to_dict()
     ```=
     {
       "state": "complete",
@@ -624,7 +906,7 @@ def parse_expr(expr):
       ]
     }
     ```?
-    parse_expr("`one` or False")
+    parse_expr("`one` or False").to_dict()
     ```=
     {
       "state": "complete",
@@ -645,7 +927,7 @@ def parse_expr(expr):
       ]
     }
     ```?
-    parse_expr("1 * 2 + 3")
+    parse_expr("1 * 2 + 3").to_dict()
     ```=
     {
       "state": "complete",
@@ -679,7 +961,7 @@ def parse_expr(expr):
       ]
     }
     ```?
-    parse_expr("1 + 2 * 3")
+    parse_expr("1 + 2 * 3").to_dict()
     ```=
     {
       "state": "complete",
@@ -714,8 +996,20 @@ def parse_expr(expr):
     }
     ```
   """
+  if expr in _PARSE_CACHE:
+    return _PARSE_CACHE[expr]
+
   units = lex_expr(expr)
-  return scrub_parents(parse_units(units))
+  tree = parse_simple_units(units)
+  if tree is None:
+    tree = scrub_parents(parse_units(units))
+
+  if len(_PARSE_CACHE) >= PARSE_CACHE_SIZE:
+    # forget the oldest entry
+    del _PARSE_CACHE[next(iter(_PARSE_CACHE))]
+  _PARSE_CACHE[expr] = tree
+
+  return tree
 
 class EvalError(Exception):
   """
@@ -723,90 +1017,205 @@ class EvalError(Exception):
   """
   pass
 
-def eval_tree(tree, story, state, module_finder):
+def compile_tree(tree, code=None):
   """
-  Evaluates a parse tree and returns an actual value. Use parse_expr to create
-  a parse tree. Returns a ((type, value), update_state) complex.
+  Compiles a parse tree (see parse_expr) into a flat list of (instruction,
+  argument) pairs which run_code can execute using a value stack instead of
+  recursing through the tree. Operations on literal values are computed
+  during compilation when their results are immutable. If a code list is
+  given, instructions are appended to it, and it is returned.
+
+  Examples:
+    ```?
+    compile_tree(parse_expr("x + 2"))
+    ```=
+    [(INS_LOAD, "x"), (INS_PUSH, 2), (INS_APPLY, (ops.OP_PLUS, 2))]
+    ```?
+    compile_tree(parse_expr("x + 2 * 3"))
+    ```=
+    [(INS_LOAD, "x"), (INS_PUSH, 6), (INS_APPLY, (ops.OP_PLUS, 2))]
+    ```?
+    compile_tree(parse_expr("1 / 0"))
+    ```=
+    [(INS_PUSH, 1), (INS_PUSH, 0), (INS_APPLY, (ops.OPCODES['/'], 2))]
+    ```?
+    compile_tree(parse_expr("`a` or 0"))
+    ```=
+    [(INS_PUSH, "a"), (INS_OR, 4), (INS_PUSH, 0), (INS_BOOL, None)]
+    ```?
+    compile_tree(parse_expr("`a b` ^^ ` `"))
+    ```=
+    [(INS_PUSH, "a b"), (INS_PUSH, " "), (INS_APPLY, (ops.OPCODES['^^'], 2))]
+    ```
   """
-  # Handle the base cases:
-  if tree["op"] in ("value", "opval"):
-    rv = tree["value"]
+  if code is None:
+    code = []
+
+  op = tree.op
+  if op in ("value", "opval"):
+    rv = tree.value
     if isinstance(rv, FunctionCall):
-      return eval_macro(rv.name, rv.args, story, state, module_finder)
+      code.append((INS_CALL, rv))
     elif isinstance(rv, VariableLookup):
-      if rv.name in state:
-        return state[rv.name], state
-      else:
-        return error("Unknown variable '{}'.".format(rv.name), state)
+      code.append((INS_LOAD, rv.name))
     else:
-      return rv, state
+      code.append((INS_PUSH, rv))
 
-  # Short-circuiting and other special-case operators:
-  if tree["op"] == 'or':
-    val, state = eval_tree(tree["args"][0], story, state, module_finder)
-    if ops.is_true(val):
-      return ("boolean", True), state
-    else:
-      val, state = eval_tree(tree["args"][1], story, state, module_finder)
-      return ("boolean", ops.is_true(val)), state
-  elif tree["op"] == 'and':
-    val, state = eval_tree(tree["args"][0], story, state, module_finder)
-    if not ops.is_true(val):
-      return ("boolean", False), state
-    else:
-      val, state = eval_tree(tree["args"][1], story, state, module_finder)
-      return ("boolean", ops.is_true(val)), state
-  elif tree["op"] == '!':
-    val, state = eval_tree(tree["args"][0], story, state, module_finder)
-    if isinstance(val, list):
-      mstate = {}
-      mstate.update(state)
-      mstate['@'] = v
-      results = []
-      for i, v in enumerate(val):
-        mstate['#'] = ("int", i)
-        mstate['?'] = v
-        rv, mstate = eval_tree(tree["args"][1], story, mstate, module_finder)
-        results.append(rv)
-
-      del mstate['#']
-      del mstate['?']
-      del mstate['@']
-      state.update(mstate)
-      return results, state
-    elif isinstance(val, dict):
-      mstate = {}
-      mstate.update(state)
-      mstate['@'] = val
-      results = {}
-      for k in val:
-        mstate['#'] = k
-        mstate['?'] = val[k]
-        rv, mstate = eval_tree(tree["args"][1], story, mstate, module_finder)
-        results[k] = rv
-
-      del mstate['#']
-      del mstate['?']
-      del mstate['@']
-      state.update(mstate)
-      return results, state
-    else:
-      raise EvalError("Cannot map over value: {}".format(val))
+  elif tree.code == ops.OP_OR or tree.code == ops.OP_AND:
+    # Short-circuit: jump past the second operand if the first decides things
+    compile_tree(tree.args[0], code)
+    jump = len(code)
+    code.append(None) # placeholder until the jump target is known
+    compile_tree(tree.args[1], code)
+    code.append((INS_BOOL, None))
+    code[jump] = (INS_OR if tree.code == ops.OP_OR else INS_AND, len(code))
+
+  elif tree.code == ops.OP_MAP:
+    compile_tree(tree.args[0], code)
+    code.append((INS_MAP, compile_tree(tree.args[1])))
+
+  else:
+    start = len(code)
+    for a in tree.args:
+      compile_tree(a, code)
+    n = len(tree.args)
+    if (
+      len(code) - start == n
+  and all(ins == INS_PUSH for ins, _ in code[start:])
+    ):
+      # Every operand is a literal, so fold the operation now (operators don't
+      # depend on state); errors are left to surface when the code runs. The
+      # folded value is pushed by every run of this code, so only immutable
+      # results are folded (nothing may modify a pushed value in place):
+      try:
+        val, _ = ops.code_result(tree.code, None, *(v for _, v in code[start:]))
+      except Exception:
+        pass
+      else:
+        if isinstance(val, IMMUTABLE_TYPES):
+          del code[start:]
+          code.append((INS_PUSH, val))
+          return code
+    code.append((INS_APPLY, (tree.code, n)))
+
+  return code
+
+def run_code(code, story, state, module_finder):
+  """
+  Runs code produced by compile_tree, returning a result-value, updated-state
+  pair.
+  """
+  stack = []
+  push = stack.append
+  pop = stack.pop
+  pc = 0
+  end = len(code)
+  while pc < end:
+    ins, arg = code[pc]
+    pc += 1
+    if ins == INS_PUSH:
+      push(arg)
+    elif ins == INS_APPLY:
+      op, n = arg
+      args = stack[-n:]
+      del stack[-n:]
+      val, state = ops.code_result(op, state, *args)
+      push(val)
+    elif ins == INS_LOAD:
+      # (the context stack takes priority since older saved states may still
+      # hold a stale '_context' entry)
+      if arg == "_context" and _CTX_STACK:
+        push(_CTX_STACK[-1])
+      elif arg in state:
+        push(state[arg])
+      else:
+        val, state = error("Unknown variable '{}'.".format(arg), state)
+        push(val)
+    elif ins == INS_CALL:
+      val, state = eval_macro(arg.name, arg.args, story, state, module_finder)
+      push(val)
+    elif ins == INS_OR:
+      if ops.is_true(pop()):
+        push(("boolean", True))
+        pc = arg
+    elif ins == INS_AND:
+      if not ops.is_true(pop()):
+        push(("boolean", False))
+        pc = arg
+    elif ins == INS_BOOL:
+      push(("boolean", ops.is_true(pop())))
+    else: # ins == INS_MAP
+      val, state = map_values(pop(), arg, story, state, module_finder)
+      push(val)
+
+  return stack[-1], state
+
+def map_values(val, code, story, state, module_finder):
+  """
+  Implements the '!' operator: runs the given code once for each item in the
+  given list or dictionary, with '@' set to the whole collection, '#' to the
+  index or key, and '?' to the item. Returns a list or dictionary of results
+  along with the updated state.
+  """
+  if isinstance(val, list):
+    mstate = {}
+    mstate.update(state)
+    mstate['@'] = val
+    results = []
+    for i, v in enumerate(val):
+      mstate['#'] = ("int", i)
+      mstate['?'] = v
+      rv, mstate = run_code(code, story, mstate, module_finder)
+      results.append(rv)
+  elif isinstance(val, dict):
+    mstate = {}
+    mstate.update(state)
+    mstate['@'] = val
+    results = {}
+    for k, v in val.items():
+      mstate['#'] = k
+      mstate['?'] = v
+      rv, mstate = run_code(code, story, mstate, module_finder)
+      results[k] = rv
+  else:
+    raise EvalError("Cannot map over value: {}".format(val))
 
-  # Get the recursion out of the way:
-  arg_values = []
-  for a in tree["args"]:
-    av, state = eval_tree(a, story, state, module_finder)
-    arg_values.append(av)
+  mstate.pop('#', None)
+  mstate.pop('?', None)
+  del mstate['@']
+  state.update(mstate)
+  return results, state
 
-  # Operator implementations:
-  return ops.op_result(tree["op"], state, *arg_values)
+def eval_tree(tree, story, state, module_finder):
+  """
+  Evaluates a parse tree and returns an actual value. Use parse_expr to create
+  a parse tree. Returns a ((type, value), update_state) complex.
+  """
+  return run_code(compile_tree(tree), story, state, module_finder)
 
+def compile_expr(expr):
+  """
+  Parses and compiles an expression (see parse_expr and compile_tree). Compiled
+  code is cached by expression (up to PARSE_CACHE_SIZE of them).
+  """
+  if expr in _CODE_CACHE:
+    return _CODE_CACHE[expr]
+
+  code = compile_tree(parse_expr(expr))
+
+  if len(_CODE_CACHE) >= PARSE_CACHE_SIZE:
+    # forget the oldest entry
+    del _CODE_CACHE[next(iter(_CODE_CACHE))]
+  _CODE_CACHE[expr] = code
+
+  return code
 
 def eval_expr(expr, story, state, module_finder=None):
   """
   Evaluates an expression, which may include both macro calls and operators.
-  Returns a result-value, updated-state pair.
+  Returns a result-value, updated-state pair. The given state may be updated
+  in place (eval_text copies the state it's given, so expressions evaluated
+  during text evaluation only ever update that copy).
 
   Exmaples:
     ```?
@@ -823,17 +1232,14 @@ def eval_expr(expr, story, state, module_finder=None):
     (1, {})
     ```
   """
-  state = copy.deepcopy(state)
-
-  pt = parse_expr(expr)
-
-  return eval_tree(pt, story, state, module_finder)
+  return run_code(compile_expr(expr), story, state, module_finder)
 
 def eval_macro(name, args, story, state, module_finder=None):
   """
   Evaluates the macro with the given name in the context of the given story,
   feeding in the given arguments and using the given state. A return-value,
-  updated-state pair is returned.
+  updated-state pair is returned. Like eval_expr, this may update the given
+  state in place.
 
   The given module_finder function should accept a module name and return a
   Story object for that module, or None if the module can't be found.
@@ -865,95 +1271,214 @@ def eval_macro(name, args, story, state, module_finder=None):
     )
     ```=
     ( "yes", {} )
+    ```?
+    eval_macro(
+      "show",
+      [" a ", " b "],
+      type( # Fake story with a single node:
+        "T",
+        (),
+        {
+          "title": "_",
+          "nodes": {
+            "show": type("N", (), { "content": "ctx=(eval~ _context)" })()
+          }
+        }
+      )(),
+      { "_context": [] } # stale entry from an older saved state
+    )
+    ```=
+    ( "ctx=[' a ', ' b ']", { "_context": [] } )
+    ```>
+    (lambda f: f() is not f())(
+      lambda: eval_macro(
+        "eval",
+        ["`a b` ^^ ` `"],
+        type("T", (), { "title": "_", "nodes": {} })(),
+        {}
+      )[0]
+    )
+    ```?
+    eval_text(
+      "(show~ a ~ b )",
+      type( # Fake story whose node uses list operators on its context:
+        "T",
+        (),
+        {
+          "title": "_",
+          "nodes": {
+            "show": type(
+              "N",
+              (),
+              {
+                "content": (
+                  "(eval~ 0 ~ _context / ` a `)"
+                + " (eval~ 0 ~ _context + _context)"
+                )
+              }
+            )()
+          }
+        }
+      )(),
+      {}
+    )
+    ```=
+    ( "[0, True] [0, [' a ', ' b ', ' a ', ' b ']]", {} )
     ```
   """
-  state = copy.deepcopy(state)
+  kind, target = resolve_macro(name, story, module_finder)
 
-  if name in story.nodes: # node-as-macro call
-    node = story.nodes[name]
+  if kind == "node": # node-as-macro call (possibly from a module)
+    # TODO: Some way to return a non-string here?
+    # (the node's _context is a list even when args is a cached tuple from
+    # scan_text, so that list operators work on it)
+    return eval_text(target.content, story, state, list(args), module_finder)
+
+  elif kind == "error":
+    return error(target, state)
+
+  # Otherwise it's a built-in macro:
+  builtin = target
+  lo, hi = builtin.arity
+  if len(args) < lo or (hi is not None and len(args) > hi):
+    return error(
+      "Built-in '{}' takes {} argument(s), but was given {}.".format(
+        name,
+        lo if lo == hi else (
+          "at least {}".format(lo) if hi is None
+          else "{} to {}".format(lo, hi)
+        ),
+        len(args)
+      ),
+      state
+    )
+  key = (name, tuple(args))
+  cached = _MACRO_CACHE.get(key)
+  if cached is not None and cached is not IMPURE:
+    return cached[0], state
+
+  n_errors = len(state.get("_errors_", ()))
+
+  try:
+    result, new_state = builtin(module_finder, story, state, *args)
+  except Exception as e:
+    return error(
+      "Error calling built-in '{}' with arguments:\n{}\nDetails:\n{}"
+      .format(
+        name,
+        '\n'.join(str(a) for a in args),
+        ''.join(
+          traceback.format_exception(
+            type(e),
+            e,
+            e.__traceback__
+          )
+        )
+      ),
+      state
+    )
 
-    return eval_text(node.content, story, state, args, module_finder)
+  if cached is None:
+    # First time seeing this call: remember its result if it didn't depend
+    # on or change the state. The cached result is handed out to every later
+    # call, so only immutable results are remembered (nothing may modify a
+    # macro's result in place).
+    if (
+      name in PURE_BUILTINS
+  and isinstance(result, IMMUTABLE_TYPES)
+  and len(new_state.get("_errors_", ())) == n_errors
+  and all(constant_arg(a) for a in args)
+    ):
+      cached = (result,)
+    else:
+      cached = IMPURE
+    if len(_MACRO_CACHE) >= MACRO_CACHE_SIZE:
+      # forget the oldest entry
+      del _MACRO_CACHE[next(iter(_MACRO_CACHE))]
+    _MACRO_CACHE[key] = cached
+
+  return result, new_state
+
+def resolve_macro(name, story, module_finder=None):
+  """
+  Works out what the macro with the given name refers to in the given story.
+  Returns a (kind, target) pair, where the kind is one of:
+
+    "node": The target is a StoryNode (from the story or one of its modules)
+        whose content should be evaluated.
+    "builtin": The target is the built-in macro function.
+    "error": The target is an error message explaining why the name couldn't
+        be resolved.
+
+  Examples:
+    ```?
+    resolve_macro(
+      "if",
+      eval( # Fake object with .nodes and .title (without importing story):
+        "[exec('class T: pass\\\\nt = T()\\\\nt.nodes = {}"
+      + "\\\\nt.title=\\\"_\\\"'), "
+      + "eval('t')][1]"
+      )
+    )
+    ```=
+    ("builtin", if_)
+    ```
+  """
+  if name in story.nodes: # node-as-macro call
+    return "node", story.nodes[name]
 
   # Must be built-in or from a module:
   # Try to resolve as a module:
-  if name.count('.') == 1: # From a module
-    module_name, inner_name = name.split('.')
+  module_name, dot, inner_name = name.partition('.')
+  if dot and '.' not in inner_name: # From a module
 
     if module_name not in story.modules:
-      return error(
+      return "error", (
         "Module '{}' for macro '{}' is not included by story '{}'.".format(
           module_name,
           name,
           story.title
-        ),
-        state
+        )
       )
 
     if not module_finder:
-      return error(
+      return "error", (
         "Attempt to use module '{}' without a module finder.".format(
           module_name
-        ),
-        state
+        )
       )
 
     module = module_finder(module_name)
 
     if not module:
-      return error("Module '{}' not found.".format(module_name), state)
+      return "error", "Module '{}' not found.".format(module_name)
 
     if inner_name not in module.nodes:
-      return error(
+      return "error", (
         "Module '{}' doesn't define macro '{}'.".format(
           module_name,
           inner_name
-        ),
-        state
+        )
       )
 
-    node = module.nodes[inner_name]
-    # TODO: Some way to return a non-string here?
-    return eval_text(
-      node.content,
-      story,
-      state,
-      args,
-      module_finder
-    )
+    return "node", module.nodes[inner_name]
 
   # if it's not a module reference, it might be a builtin?
-  elif name in BUILTINS: # A built-in macro
-    try:
-      return BUILTINS[name](module_finder, story, state, *args)
-    except Exception as e:
-      return error(
-        "Error calling built-in '{}' with arguments:\n{}\nDetails:\n{}"
-        .format(
-          name,
-          '\n'.join(str(a) for a in args),
-          ''.join(
-            traceback.format_exception(
-              type(e),
-              e,
-              e.__traceback__
-            )
-          )
-        ),
-        state
-      )
+  builtin = BUILTINS.get(name)
+  if builtin is not None:
+    return "builtin", builtin
 
   # otherwise we don't know what this macro is...
-  else:
-    # Unrecognized macro: expands to error text
-    # TODO: Better error text
-    return error("Unrecognized macro '{}'.".format(name), state)
+  # TODO: Better error text
+  return "error", "Unrecognized macro '{}'.".format(name)
 
 def eval_text(text, story, state, context=None, module_finder=None):
   """
   Evaluates a string which may contain macros. Treats everything that's not
   explicitly a macro as text. Returns a pair of computed-value, modified-state,
   although the values of local variables (those that start with '_') will not
-  be affected.
+  be affected. Text that can't contain any macros is returned along with the
+  given state itself rather than a copy.
 
   Context may be specified as a list of values.
 
@@ -1037,74 +1562,59 @@ Ahead of you, a few [pines] proudly retain their needles.
 
 Of course, you could just start searching among the oaks and maples right [here]
 '''
+    ```>
+    (lambda s: eval_text("no (macros) here", None, s)[1] is s)({"x": 1})
     ```
   """
+  # Every macro start ends with '~', so without one there's nothing to do:
+  if '~' not in text:
+    return text, state
+
   context = context or []
 
-  state = copy.deepcopy(state)
+  state = copy_state(state)
 
-  # Preserve local variables:
-  local_vars = {
-    v: copy.deepcopy(state[v])
-      for v in state
-      if v.startswith('_') and not v.endswith('_')
-  }
+  # Preserve local variables (values are never modified in place, so keeping
+  # references is enough):
+  local_vars = state.local_items()
 
   # Set context:
-  state["_context"] = context
-
-  # Split up text into strings and macros:
-  i = 0
-  bits = []
-  while i < len(text):
-    ms = MACRO_START.search(text, i)
-    if not ms: # no matches means no expansion needed
-      bits.append(text[i:])
-      i = len(text) # we're done
-    else:
-      # There's a match:
-      start = ms.start()
-      try:
-        end = utils.matching_brace(text, start, '(', ')')
-      except utils.UnmatchedError as e:
-        ectx = text[max(0, i-10):i+50]
-        ectx = ectx \
-          .replace('\n', '\u2424') \
-          .replace('\r', '\u240d') \
-          .replace('\t', '\u2409')
-        eii = 10 - max(0, 10 - i)
-        print(
-          "Warning: Unclosed macro treated as text as position {} in:\n{}\n{}"
-          .format(
-            start,
-            ectx,
-            ' '*eii + '^' + ' '*(60 - eii - 1)
-          ),
-          file=sys.stderr
-        )
-        i = ms.end() + 1 # skip past that match
+  _CTX_STACK.append(context)
+  try:
+    bits = []
+    append = bits.append # (bound to a local to skip lookups in the loop)
+    for literal, macro_name, macro_args in scan_text(text):
+      append(literal)
+      if macro_name is None:
         continue
 
-      # start and end found -> first add text before macro:
-      bits.append(text[i:start])
-      i = end + 1
-
       # eval macro:
-      macro_name = ms.group(1)
-      macro_content = text[ms.end():end]
-      macro_args = split_macro_args(macro_content)
-
-      mv, state = eval_macro(macro_name, macro_args, story, state,module_finder)
-      bits.append(to_string(mv))
+      mv, state = eval_macro(
+        macro_name,
+        macro_args,
+        story,
+        state,
+        module_finder
+      )
+      # (most macros expand to strings, so skip the call for those)
+      append(mv if type(mv) is str else to_string(mv))
+  finally:
+    _CTX_STACK.pop()
 
-  # Restore locals:
-  state.update(local_vars)
+  # Restore locals (most texts don't touch them, so only rebind those that
+  # were changed or removed):
+  for k, v in local_vars.items():
+    if k not in state or state[k] is not v:
+      state[k] = v
 
   return ''.join(bits), state
 
 def error(message, state):
   """
-  Returns an expansion-text, updated-state pair for the given error.
+  Returns an expansion-text, updated-state pair for the given error. The
+  message is appended to the state's _errors_ list, which is an append-only log
+  deliberately shared by all copies of a state (see state.copy_state), so
+  recording an error never copies the errors before it.
   """
   message = "Error: " + message
   exp = "<<{}>>".format(message)
@@ -1114,18 +1624,29 @@ def error(message, state):
   return exp, state
 
 def pt_string(parse_tree, indent=0):
-  result = ''
+  parts = []
+  pt_write(parse_tree, indent, '\n', parts)
+  return ''.join(parts)
+
+def pt_write(parse_tree, indent, newline, out):
+  """
+  Does the work for pt_string, appending pieces of the result to the given
+  list. Rather than re-indenting each sub-tree's finished string, newlines
+  are written out as the given newline string, which includes the
+  indentation for every enclosing level.
+  """
+  if isinstance(parse_tree, ParseNode):
+    parse_tree = parse_tree.to_dict()
   for k in parse_tree:
     if k not in ("parent", "args"):
-      result += "{}: {}\n".format(k, parse_tree[k])
+      out.append("{}: {}\n".format(k, parse_tree[k]).replace('\n', newline))
 
   if "args" in parse_tree:
     ind = ' '*(indent+2)
-    result += "args:\n"
+    out.append("args:" + newline)
     for a in parse_tree["args"]:
-      result += ('\n' + ind).join((ind + pt_string(a, indent+2)).split('\n'))
-
-  return result
+      out.append(ind)
+      pt_write(a, indent+2, newline + ind, out)
 
 # Macro built-in functions:
 # -------------------------
@@ -1144,12 +1665,13 @@ def set_(mf, story, state, var, expr):
 @mb
 def add(mf, story, state, var, expr):
   """
-  The 'set' macro builtin. Modifies a state variable, and returns the computed
+  The 'add' macro builtin. Adds to a state variable, and returns the computed
   offset value.
   """
   # TODO: Eval var as text?
   val, state = eval_expr(expr, story, state, mf)
-  state[var.strip()] += val
+  var = var.strip()
+  state[var] = state[var] + val
   return val, state
 
 @mb
@@ -1159,7 +1681,7 @@ def eval_(mf, story, state, *args):
   a single value or a list of values if there is more than one argument.
   """
   if len(args) == 1:
-    return eval_expr(arg, story, state, mf)
+    return eval_expr(args[0], story, state, mf)
   else:
     result = []
     for arg in args:
@@ -1174,11 +1696,11 @@ def text(mf, story, state, *args):
   together into a single result string.
   """
   if len(args) == 1:
-    return eval_text(arg, story, state, mf)
+    return eval_text(args[0], story, state, module_finder=mf)
   else:
     results = []
     for arg in args:
-      val, state = eval_text(arg, story, state, mf)
+      val, state = eval_text(arg, story, state, module_finder=mf)
       results.append(val)
     return ''.join(results), state
 
@@ -1194,10 +1716,7 @@ def lookup(mf, story, state, obj, key):
   if key in obj:
     return obj[key], state
   else:
-    return (
-      error("Lookup failed to find '{}' in '{}'.".format(key, obj)),
-      state
-    )
+    return error("Lookup failed to find '{}' in '{}'.".format(key, obj), state)
 
 @mb
 def context(mf, story, state, n):
@@ -1206,8 +1725,9 @@ def context(mf, story, state, n):
   after evaluating the given expression to find n.
   """
   n, state = eval_expr(n, story, state, mf)
-  if n >= 1 and n <= len(state["_context"]):
-    return state["_context"][n-1], state
+  ctx = _CTX_STACK[-1] if _CTX_STACK else []
+  if n >= 1 and n <= len(ctx):
+    return ctx[n-1], state
   else:
     # Invalid indices just result in an empty string.
     return None, state
@@ -1234,30 +1754,20 @@ def cond_base(mf, story, state, *args, as_text=False):
   """
   Base code for 'if' and 'select'.
   """
-  odd = [args[i] for i in range(0, len(args), 2)]
-  even = [args[i] for i in range(1, len(args), 2)]
-  # Leftover becomes an implicit else case:
-  # TODO: Issue warning here?
-  el = None
-  if len(odd) > len(even):
-    el = odd.pop()
-
-  for i, arg in enumerate(odd):
-    val, state = eval_expr(arg, story, state, mf)
+  evaluate = eval_text if as_text else eval_expr
+  it = iter(args)
+  for cond in it:
+    body = next(it, None)
+    if body is None:
+      # Leftover becomes an implicit else case:
+      # TODO: Issue warning here?
+      return evaluate(cond, story, state, module_finder=mf)
+    val, state = eval_expr(cond, story, state, mf)
     if val: # the string "else" will pass this test
-      if as_text:
-        return eval_text(even[i], story, state, mf)
-      else:
-        return eval_expr(even[i], story, state, mf)
+      return evaluate(body, story, state, module_finder=mf)
 
   # No condition was true:
-  if el is None:
-    return None, state
-  else:
-    if as_text:
-      return eval_text(el, story, state, mf)
-    else:
-      return eval_expr(el, story, state, mf)
+  return None, state
 
 @mb
 def once(mf, story, state, arg):
@@ -1267,7 +1777,7 @@ def once(mf, story, state, arg):
   an empty string.
   """
   if state["_first"]:
-    return eval_text(arg, story, state, mf)
+    return eval_text(arg, story, state, module_finder=mf)
   else:
     return "", state
 
@@ -1280,4 +1790,4 @@ def again(mf, story, state, arg):
   if state["_first"]:
     return "", state
   else:
-    return eval_text(arg, story, state, mf)
+    return eval_text(arg, story, state, module_finder=mf)
@@ -4,6 +4,9 @@ ops.py
 Operator definitions for firelight macros.
 """
 
+import re
+import operator
+
 OPERATOR_PRECEDENCE = {
   '[': 10000,
   '.': 50,
@@ -32,8 +35,40 @@ OPERATOR_PRECEDENCE = {
   'not': 5,
 }
 
+# Integer opcodes for each operator, in precedence-table order. The lexer emits
+# these instead of operator strings so that the parser can dispatch using
+# integer comparisons; OPERATORS maps opcodes back to operator strings.
+OPERATORS = tuple(OPERATOR_PRECEDENCE)
+OPCODES = { o: i for i, o in enumerate(OPERATORS) }
+
+# Operator precedence indexed by opcode:
+PRECEDENCE = tuple(OPERATOR_PRECEDENCE[o] for o in OPERATORS)
+
+OP_INDEX = OPCODES['[']
+OP_DOT = OPCODES['.']
+OP_PLUS = OPCODES['+']
+OP_MINUS = OPCODES['-']
+OP_MOD = OPCODES['%']
+OP_REPLACE = OPCODES['%%']
+OP_PIPE = OPCODES['|']
+OP_MAP = OPCODES['!']
+OP_AND = OPCODES['and']
+OP_OR = OPCODES['or']
+OP_NOT = OPCODES['not']
+
+UNARY_OPCODES = (OP_PLUS, OP_MINUS, OP_NOT)
+
 ALL_OPS = {}
 
+# Maps (opcode, argument type, ...) tuples to implementations (see code_result)
+RESOLVED_OPS = {}
+
+# Maximum number of distinct regular expressions kept compiled by pattern:
+PATTERN_CACHE_SIZE = 1024
+
+# Maps regular expression strings to compiled patterns (see pattern):
+PATTERNS = {}
+
 class OpError(Exception):
   """
   An OpError indicates a problem with an operator.
@@ -42,10 +77,16 @@ class OpError(Exception):
 
 class Operator:
   """
-  A class representing an operator.
+  A class representing an operator. May be constructed from either an operator
+  string or an opcode (see OPCODES); both are available as attributes.
   """
   def __init__(self, op):
-    self.op = op
+    if isinstance(op, int):
+      self.code = op
+      self.op = OPERATORS[op]
+    else:
+      self.op = op
+      self.code = OPCODES[op]
 
 def op(op, *types):
   """
@@ -67,7 +108,13 @@ def resolve_op(op, *args):
   if op not in ALL_OPS:
     raise OpError("Unknown operation '{}'".format(op))
 
-  candidates = ALL_OPS[op]
+  return match_op(op, ALL_OPS[op], args)
+
+def match_op(op, candidates, args):
+  """
+  Picks the first of the given candidate implementations of op (see ALL_OPS)
+  that matches the given arguments.
+  """
   for c in candidates:
     if len(c) != len(args)+1:
       continue
@@ -87,11 +134,50 @@ def resolve_op(op, *args):
 def op_result(op, state, *args):
   """
   Returns the result (using resolve_op) of an operation between one or more
-  (type, value) pairs.
+  (type, value) pairs. Known operators go through code_result, so that their
+  resolution is cached.
   """
+  if op in OPCODES:
+    return code_result(OPCODES[op], state, *args)
   f = resolve_op(op, *args)
   return f(state, *args)
 
+def code_result(code, state, *args):
+  """
+  Works like op_result, but takes an opcode (see OPCODES) instead of an
+  operator string, and finds candidates by indexing OPS_BY_CODE. Resolved
+  implementations are cached in RESOLVED_OPS by opcode and argument types.
+  """
+  # Matching only depends on argument types, so remember the choice for each
+  # opcode/type combination:
+  key = (code, *map(type, args))
+  f = RESOLVED_OPS.get(key)
+  if f is None:
+    candidates = OPS_BY_CODE[code]
+    if not candidates:
+      raise OpError("Unknown operation '{}'".format(OPERATORS[code]))
+    f = match_op(OPERATORS[code], candidates, args)
+    RESOLVED_OPS[key] = f
+  return f(state, *args)
+
+def pattern(regex):
+  """
+  Returns a compiled version of the given regular expression string,
+  remembering up to PATTERN_CACHE_SIZE of them so that string operators used
+  repeatedly don't have to go through re's own cache lookup every time.
+  """
+  if regex in PATTERNS:
+    return PATTERNS[regex]
+
+  result = re.compile(regex)
+
+  if len(PATTERNS) >= PATTERN_CACHE_SIZE:
+    # forget the oldest entry
+    del PATTERNS[next(iter(PATTERNS))]
+  PATTERNS[regex] = result
+
+  return result
+
 def is_true(val):
   """
   Truth-value assignment (just copies Python).
@@ -184,65 +270,23 @@ def eq(state, lhs, rhs):
 def neq(state, lhs, rhs):
   return lhs != rhs, state
 
-@op('<', '*', '*')
-def less(state, lhs, rhs):
-  if (
-    isinstance(lhs, type(rhs))
- or isinstance(rhs, type(lhs))
- or (is_numeric(type(lhs)) and is_numeric(type(rhs)))
-  ):
-    try:
-      return lhs < rhs, state
-    except TypeError:
-      return False, state
-  else:
-    # TODO: Use string comparison here?
-    return False, state
-
-@op('>', '*', '*')
-def greater(state, lhs, rhs):
-  if (
-    isinstance(lhs, type(rhs))
- or isinstance(rhs, type(lhs))
- or (is_numeric(type(lhs)) and is_numeric(type(rhs)))
-  ):
-    try:
-      return lhs > rhs, state
-    except TypeError:
-      return False, state
-  else:
-    # TODO: Use string comparison here?
-    return False, state
-
-@op('<=', '*', '*')
-def leq(state, lhs, rhs):
-  if (
-    isinstance(lhs, type(rhs))
- or isinstance(rhs, type(lhs))
- or (is_numeric(type(lhs)) and is_numeric(type(rhs)))
-  ):
-    try:
-      return lhs <= rhs, state
-    except TypeError:
-      return False, state
-  else:
-    # TODO: Use string comparison here?
-    return False, state
-
-@op('>=', '*', '*')
-def geq(state, lhs, rhs):
-  if (
-    isinstance(lhs, type(rhs))
- or isinstance(rhs, type(lhs))
- or (is_numeric(type(lhs)) and is_numeric(type(rhs)))
-  ):
+def ordering(compare):
+  """
+  Builds an ordering operator from the given comparison function (e.g.,
+  operator.lt). Values that can't be compared are never ordered.
+  """
+  def ordering_op(state, lhs, rhs):
     try:
-      return lhs >= rhs, state
-    except TypeError:
+      return compare(lhs, rhs), state
+    except TypeError: # incomparable types
+      # TODO: Use string comparison here?
       return False, state
-  else:
-    # TODO: Use string comparison here?
-    return False, state
+  return ordering_op
+
+less = op('<', '*', '*')(ordering(operator.lt))
+greater = op('>', '*', '*')(ordering(operator.gt))
+leq = op('<=', '*', '*')(ordering(operator.le))
+geq = op('>=', '*', '*')(ordering(operator.ge))
 
 # Note: boolean operators are handled in macro.py because they're
 # short-circuiting.
@@ -279,7 +323,7 @@ def times_str(state, lhs, rhs):
 
 @op('/', str, str)
 def search_str(state, lhs, rhs):
-  return re.search(rhs, lhs) != None, state
+  return pattern(rhs).search(lhs) != None, state
 
 @op('//', str, str)
 def search_simple_str(state, lhs, rhs):
@@ -287,7 +331,7 @@ def search_simple_str(state, lhs, rhs):
 
 @op('%', str, str, str)
 def replace_str(state, lhs, rhs, rrhs):
-  return re.sub(rhs, rrhs, lhs), state
+  return pattern(rhs).sub(rrhs, lhs), state
 
 @op('%%', str, str, str)
 def replace_simple_str(state, lhs, rhs, rrhs):
@@ -295,7 +339,7 @@ def replace_simple_str(state, lhs, rhs, rrhs):
 
 @op('^', str, str)
 def split_str(state, lhs, rhs):
-  return re.split(rhs, lhs), state
+  return pattern(rhs).split(lhs), state
 
 @op('^^', str, str)
 def split_str(state, lhs, rhs):
@@ -310,15 +354,11 @@ def cat_lst(state, lhs, rhs):
 
 @op('.', list, "*")
 def app_lst(state, lhs, rhs):
-  return ("list", lhs[:] + [ rhs ]), state
+  return lhs + [ rhs ], state
 
 @op('*', list, int)
 def times_lst(state, lhs, rhs):
-  result = []
-  for i in range(rhs):
-    for v in lhs:
-      result.append(v)
-  return result, state
+  return lhs * rhs, state
 
 @op('/', list, "*")
 def search_lst(state, lhs, rhs):
@@ -351,10 +391,12 @@ def reduce_lst(state, lst, op, val):
     else:
       return None, state
 
+  # The value is applied between each pair of items, like a separator (so
+  # "x | + `, `" joins x with commas):
   result = lst[0]
   for lv in lst[1:]:
-    result, state = op_result(op, state, result, val)
-    result, state = op_result(op, state, result, lv)
+    result, state = code_result(op.code, state, result, val)
+    result, state = code_result(op.code, state, result, lv)
 
   return result, state
 
@@ -365,17 +407,11 @@ def reduce_lst(state, lst, op, val):
 
 @op('+', dict, dict)
 def union_dict(state, lhs, rhs):
-  result = {}
-  result.update(lhs)
-  result.update(rhs)
-  return result, state
+  return {**lhs, **rhs}, state
 
 @op('|', dict, dict)
 def rev_union_dict(state, lhs, rhs):
-  result = {}
-  result.update(rhs)
-  result.update(lhs)
-  return result, state
+  return {**rhs, **lhs}, state
 
 @op('&', dict, dict)
 def intersect_dict(state, lhs, rhs):
@@ -395,10 +431,7 @@ def sub_dict(state, lhs, rhs):
 
 @op('.', dict, "*", "*")
 def ins_dict(state, lhs, key, val):
-  result = {}
-  result.update(lhs)
-  result[key] = val
-  return result, state
+  return {**lhs, key: val}, state
 
 # Default string operators
 # ------------------------
@@ -410,3 +443,7 @@ def plus_str_default(state, lhs, rhs):
 @op('+', "*", str)
 def plus_default_str(state, lhs, rhs):
   return str(lhs) + rhs, state
+
+# Candidate implementations indexed by opcode, for code_result (this must come
+# after all of the definitions above):
+OPS_BY_CODE = tuple(ALL_OPS.get(o, ()) for o in OPERATORS)
@@ -20,11 +20,16 @@ NODE_START = re.compile(
   r"^\s*#\s*([A-Za-z0-9_.-][A-Za-z0-9_.-]*)\s*$",
   re.MULTILINE
 )
+# Matches the first '[' of each '[[' that might start a link (the lookahead
+# lets overlapping candidates like those in '[[[' each be tried):
+LINK_START = re.compile(r"\[(?=\[)")
 
 def remove_comments(src):
   """
   Removes comments from the given source, returning a revised string.
   """
+  if '``' not in src: # no comments to remove
+    return src
   return COMMENT.sub("", src)
 
 def normalize_newlines(src):
@@ -32,6 +37,8 @@ def normalize_newlines(src):
   Returns a version of the given text where all newline variants have been
   converted to simple '\\n'.
   """
+  if '\r' not in src: # nothing to convert (the usual case)
+    return src
   return src.replace('\n\r', '\n').replace('\r\n', '\n').replace('\r', '\n')
 
 def reflow(src):
@@ -199,27 +206,40 @@ hello
     "modules": "[]",
     "state": "{}"
   }
-  leftovers = ""
-  lines = src.split('\n')
+  # Step through lines using str.find rather than splitting the whole source,
+  # since the metadata block is usually a small part of it:
+  # Multi-line values are collected as lists of lines and joined at the end:
+  fragments = {}
   current_key = None
-  for i, line in enumerate(lines):
+  start = 0
+  while True:
+    end = src.find('\n', start)
+    if end < 0:
+      end = len(src)
+    line = src[start:end]
     if line.strip() == '':
-      continue
+      pass
     elif line[0] == '%':
       match = META_KEY.search(line)
       if match:
         current_key = match.group(1)
-        metadata[current_key] = line[match.end():].strip()
+        fragments[current_key] = [ line[match.end():].strip() ]
       elif current_key:
-        metadata[current_key] += ' ' + line[1:].strip()
-      else:
-        continue # ignore this line
+        fragments[current_key].append(line[1:].strip())
+      # else ignore this line
     else:
       break
 
+    if end == len(src): # the last line is always kept as leftovers
+      break
+    start = end + 1
+
+  for key, lines in fragments.items():
+    metadata[key] = ' '.join(lines)
+
   metadata["state"] = json.loads(metadata["state"])
   metadata["modules"] = json.loads(metadata["modules"])
-  return metadata, '\n'.join(lines[i:])
+  return metadata, src[start:]
 
 def parse_first_node(src):
   """
@@ -255,8 +275,6 @@ def parse_first_node(src):
   if not first or first.start() != 0:
     return (None, src)
 
-  node = {}
-
   # Search for the next node, or else use the end of the source:
   second = NODE_START.search(src, pos=first.end())
   if second:
@@ -264,49 +282,66 @@ def parse_first_node(src):
   else:
     node_end = len(src)
 
+  return (
+    parse_node(first.group(1), src[first.end():node_end]),
+    src[node_end:]
+  )
+
+def parse_node(name, body):
+  """
+  Builds a StoryNode with the given name from the given node body (the source
+  between the node's header line and the start of the next node), turning
+  links into successors. See parse_first_node.
+  """
+  node = {}
+
   # Grab the name and content:
-  node["name"] = first.group(1)
-  content = reflow(src[first.end():node_end])
-  leftovers = src[node_end:]
+  node["name"] = name
+  content = reflow(body)
 
   # Find and transform all links in the text, replacing them with their display
   # text and creating link entries for each. Note that if the display text is
   # not unique, all instances within the node will be highlighted.
   link_extents = []
-  i = 0
-  while i < len(content) - 1:
-    i += 1 # we intentionally skip i = 0 since we match the second '['
-    if content[i-1:i+1] == "[[":
-      try:
-        close = utils.matching_brace(content, i, '[', ']')
-      except utils.UnmatchedError:
-        # TODO: Print a warning here?
-        continue
+  resume = 0 # links can't start inside earlier links
+  for m in LINK_START.finditer(content):
+    if m.start() < resume:
+      continue
+    i = m.end() # we match from the second '['
+    try:
+      close = utils.matching_brace(content, i, '[', ']')
+    except utils.UnmatchedError:
+      # TODO: Print a warning here?
+      continue
+
+    link_extents.append((i+1, close))
 
-      # Push to create reverse ordering so link replacement doesn't change
-      # indices of earlier link_extents.
-      link_extents.insert(0, (i+1, close))
+    # skip ahead past the end of this link
+    resume = close + 1
 
-      # jump ahead to the end of this link
-      i = close
+  # Reverse so that link replacement doesn't change indices of earlier
+  # link_extents:
+  link_extents.reverse()
 
+  # The revised content is built from pieces, which are collected
+  # last-to-first along with the links and then reversed:
+  pieces = []
+  tail = len(content) # end of the content not yet copied into pieces
   node["successors"] = {}
   for start, end in link_extents:
-    # Ordering is last-to-first, so that replacement here doesn't affect
-    # indices of earlier links.
     contents = content[start:end]
     contents = contents.strip()
     # TODO: Error if this strip results in an empty string?
 
     # First, figure out display text:
     if contents[0] == '"':
-      end, val = utils.string_literal(contents, 0, '"')
-      if '|' in contents[end:]:
-        display_end = contents.index('|',end)
-        display = val + contents[end:display_end]
+      qend, val = utils.string_literal(contents, 0, '"')
+      if '|' in contents[qend:]:
+        display_end = contents.index('|',qend)
+        display = val + contents[qend:display_end]
       else:
         display_end = len(contents)
-        display = val + contents[end:]
+        display = val + contents[qend:]
     else:
       try:
         display_end = contents.index('|')
@@ -332,8 +367,10 @@ def parse_first_node(src):
     # Finally, grab the transition text:
     transition = contents[dest_end+1:].strip()
 
-    # Revise the source to replace the link literal with its display text:
-    content = content[:start-2] + display + content[end+2:]
+    # Replace the link literal with its display text:
+    pieces.append(content[end+2:tail])
+    pieces.append(display)
+    tail = start-2
 
     # Add to our links information:
     if transition:
@@ -341,10 +378,13 @@ def parse_first_node(src):
     else:
       node["successors"][display] = [destination, ""]
 
+  pieces.append(content[:tail])
+  pieces.reverse()
+
   # Put the revised content into our node:
-  node["content"] = content
+  node["content"] = ''.join(pieces)
 
-  return (unpack(node, StoryNode), leftovers)
+  return unpack(node, StoryNode)
 
 
 def parse_story(src):
@@ -407,12 +447,18 @@ def parse_story(src):
   # Parse metadata block:
   meta, src = parse_metadata(src)
 
-  # Parse story nodes:
+  # Parse story nodes, finding all of their headers in one pass (as with
+  # parse_first_node, the source must start with a node):
+  src = src.strip()
+  headers = list(NODE_START.finditer(src))
   nodes = []
-  sn, src = parse_first_node(src)
-  while sn:
-    nodes.append(sn)
-    sn, src = parse_first_node(src)
+  if headers and headers[0].start() == 0:
+    for i, header in enumerate(headers):
+      if i + 1 < len(headers):
+        node_end = headers[i+1].start()
+      else:
+        node_end = len(src)
+      nodes.append(parse_node(header.group(1), src[header.end():node_end]))
 
   # Return result:
   return Story(
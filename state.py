@@ -194,3 +194,116 @@ class InvertValue(StateChange):
         "Can't unpack '{}' as an InvertValue change.".format(obj)
       )
     return InvertValue(bits[1])
+
+def is_local(key):
+  """
+  Whether the given state key names a local variable: one that starts with '_'
+  but doesn't end with '_' (see macro.eval_text).
+  """
+  return key[:1] == '_' and key[-1:] != '_'
+
+class StoryState(dict):
+  """
+  A dictionary of story state which keeps track of which of its keys name
+  local variables (see is_local), so that macro evaluation can find them
+  without scanning every key. Compares equal to, and serializes like, a plain
+  dictionary. The set of local keys is kept current by item assignment and
+  deletion, pop, popitem, clear, update, |=, setdefault, copy, and fromkeys;
+  other ways of changing the underlying dictionary (like calling dict methods
+  on it directly) bypass it.
+  """
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.local_keys = { k for k in self if is_local(k) }
+
+  def __setitem__(self, key, value):
+    super().__setitem__(key, value)
+    if is_local(key):
+      self.local_keys.add(key)
+
+  def __delitem__(self, key):
+    super().__delitem__(key)
+    self.local_keys.discard(key)
+
+  def pop(self, key, *default):
+    self.local_keys.discard(key)
+    return super().pop(key, *default)
+
+  def update(self, *args, **kwargs):
+    for key, value in dict(*args, **kwargs).items():
+      self[key] = value
+
+  def setdefault(self, key, default=None):
+    if key not in self:
+      self[key] = default
+    return self[key]
+
+  def popitem(self):
+    key, value = super().popitem()
+    self.local_keys.discard(key)
+    return key, value
+
+  def clear(self):
+    super().clear()
+    self.local_keys.clear()
+
+  def __ior__(self, other):
+    self.update(other)
+    return self
+
+  @classmethod
+  def fromkeys(cls, keys, value=None):
+    return cls(dict.fromkeys(keys, value))
+
+  def local_items(self):
+    """
+    Returns a dictionary of just the local variables and their values.
+    """
+    return { k: self[k] for k in self.local_keys }
+
+  def copy(self):
+    result = StoryState()
+    dict.update(result, self)
+    result.local_keys = set(self.local_keys)
+    return result
+
+  def __reduce__(self):
+    # Reconstruct from a plain dictionary so that copying and pickling don't
+    # assign items before local_keys exists.
+    return (StoryState, (dict(self),))
+
+def copy_state(state):
+  """
+  Returns a copy of the given state as a StoryState, for macro evaluation to
+  update without affecting the original. The copy is shallow: values are
+  shared with the original, so code that updates state must rebind keys to
+  new values rather than modifying existing values in place. The one
+  exception is the _errors_ list, an append-only log which macro.error adds
+  to in place so that every copy sees the same errors.
+
+  Examples:
+    ```?
+    copy_state({"a": 1, "_b": "two"})
+    ```=
+    {"a": 1, "_b": "two"}
+    ```>
+    copy_state({"_b": 2}).local_keys == {"_b"}
+    ```>
+    (lambda s: copy_state(s)["a"] is s["a"])({"a": [1, 2]})
+    ```?
+    (lambda s: [s.popitem(), s.local_items()][1])(copy_state({"a": 1, "_b": 2}))
+    ```=
+    {}
+    ```?
+    (lambda s: [s.clear(), s.__ior__({"_c": 3}), s.local_items()][2])(
+      copy_state({"_b": 2})
+    )
+    ```=
+    {"_c": 3}
+    ```>
+    StoryState.fromkeys(["a", "_b"], 0).local_keys == {"_b"}
+    ```
+  """
+  if isinstance(state, StoryState):
+    return state.copy()
+  return StoryState(state)
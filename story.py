@@ -5,6 +5,7 @@ Story functionality including tracking state and making choices. Doesn't deal
 with twitter directly.
 """
 
+import sys
 import copy
 import re
 
@@ -85,7 +86,7 @@ class StoryNode:
   pairs. Note that node names must be globally unique.
   """
   def __init__(self, name, content, successors=None):
-    self.name = name
+    self.name = sys.intern(name)
     self.content = content
     self.successors = successors or {}
 
@@ -202,8 +203,10 @@ class Story:
     self.title = title
     self.author = author
     self.start = start
-    self.nodes = nodes
-    self.modules = modules or []
+    # (node and module names are interned so that macro lookups, whose names
+    # are interned by macro.scan_text, can compare keys by identity)
+    self.nodes = { sys.intern(name): node for name, node in nodes.items() }
+    self.modules = [ sys.intern(m) for m in (modules or []) ]
     self.setup = setup or {}
     self.current_node_text = ""
     self.module_finder = module_finder
@@ -366,12 +369,15 @@ class Story:
     """
     state["_prev"] = prev
     state["_node"] = node
-    if node in state["_visited_"]:
+    # (rebind rather than update in place, since states share values)
+    visited = dict(state["_visited_"])
+    if node in visited:
       state["_first"] = False
-      state["_visited_"][node] += 1
+      visited[node] += 1
     else:
       state["_first"] = True
-      state["_visited_"][node] = 1
+      visited[node] = 1
+    state["_visited_"] = visited
     return state
 
   def begin(self, highlight="bracket"):
@@ -511,7 +517,7 @@ class Story:
     """
     Computes display text for the given node, including evaluating the node's
     content. Returns a (display_text, updated_state) pair. The 'context'
-    argument is passed as the _context variable during node evaluation, while
+    argument supplies the _context variable during node evaluation, while
     the 'highlight' variable controls how options within the text are
     highlighted (see highlight_content below) and the 'module_finder' argument
     is passed into eval_text.
@@ -542,6 +548,6 @@ class Story:
       transition_text,
       self,
       state,
-      self.module_finder
+      module_finder=self.module_finder
     )
     return result.strip(), new_state
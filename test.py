@@ -24,6 +24,7 @@ from parse import parse_story, render_story, parse_first_node, render_node
 import parse
 
 import macro
+import state
 
 import fake_api
 import load_stories
@@ -304,11 +305,19 @@ for f in [
   utils.split_unquoted,
   utils.find_quoted_regions,
   utils.matching_brace,
+  macro.find_macro_start,
+  macro.scan_text,
+  macro.constant_arg,
+  macro.lex_expr,
+  macro.match_groups,
   macro.parse_expr,
+  macro.compile_tree,
   macro.eval_expr,
   macro.eval_macro,
+  macro.resolve_macro,
   macro.eval_text,
   parse.parse_metadata,
+  state.copy_state,
 ]:
   mktest_docstring(f)
 
@@ -23,11 +23,14 @@ def or_strlist(alternatives):
   else:
     return ", ".join(alternatives[:-1]) + ", or " + alternatives[-1]
 
+# Maps spaces, tabs, and carriage returns to visible symbols for show_spaces:
+VISIBLE_SPACES = str.maketrans({ ' ': '␣', '\t': '␉', '\r': '␍' })
+
 def show_spaces(string):
   """
   Returns a string with whitespace made visible. Newlines are preserved.
   """
-  return string.replace(' ', '␣').replace('\t', '␉').replace('\r', '␍')
+  return string.translate(VISIBLE_SPACES)
 
 def dedent(string, ts=4):
   """
@@ -90,6 +93,10 @@ class UnmatchedError(Exception):
   """
   pass
 
+# Compiled patterns matching the characters that matching_brace cares about,
+# keyed by (open, close, quote) characters:
+BRACE_PATTERNS = {}
+
 def matching_brace(src, idx, op='(', cl=')', qc='"'):
   """
   Finds the matching closing brace starting from the given index in the given
@@ -121,15 +128,27 @@ def matching_brace(src, idx, op='(', cl=')', qc='"'):
     UnmatchedError
     ```
   """
+  # Jump between significant characters using a regex instead of stepping
+  # through every character in Python:
+  key = (op, cl, qc)
+  if key not in BRACE_PATTERNS:
+    BRACE_PATTERNS[key] = re.compile(
+      '[' + re.escape(op + cl + qc + '\\') + ']'
+    )
+  find_next = BRACE_PATTERNS[key].search
+
   layer = 0
   quoted = False
-  escaped = False
-  for i in range(idx+1, len(src)):
+  i = idx + 1
+  while True:
+    m = find_next(src, i)
+    if m is None:
+      break
+    i = m.start()
     c = src[i]
     if c == '\\':
-      escaped = not escaped
-    elif escaped:
-      escaped = False
+      i += 2 # skip the escaped character
+      continue
     elif c == qc:
       quoted = not quoted
     elif quoted:
@@ -143,6 +162,7 @@ def matching_brace(src, idx, op='(', cl=')', qc='"'):
         layer -= 1
     elif c == op:
       layer += 1
+    i += 1
   # must hit return in loop or else
   raise UnmatchedError(
     "Unmatched '{}' at position {} in string:\n'''\n{}\n'''".format(
@@ -155,6 +175,14 @@ def matching_brace(src, idx, op='(', cl=')', qc='"'):
     )
   )
 
+# Escape codes recognized by string_literal (besides the quote character):
+STRING_ESCAPES = {
+  '\\': '\\',
+  'n': '\n',
+  'r': '\r',
+  't': '\t',
+}
+
 def string_literal(src, idx, qc='"'):
   """
   Finds the matching end quote starting from the given index in the given
@@ -181,30 +209,25 @@ def string_literal(src, idx, qc='"'):
     (14, "two,\\"three\\"")
     ```
   """
-  escaped = False
-  result = ""
-  for i in range(idx+1, len(src)):
-    c = src[i]
-    if escaped:
-      escaped = False
-      if c == qc:
-        result += qc
-      elif c == '\\':
-        result += '\\'
-      elif c == 'n':
-        result += '\n'
-      elif c == 'r':
-        result += '\r'
-      elif c == 't':
-        result += '\t'
-      else: # unrecognized escape code
-        result += '\\' + c
-    elif c == '\\':
-      escaped = True
-    elif c == qc:
-      return (i, result)
-    else:
-      result += c
+  # Collect runs of plain text between escapes as bits and join them at the
+  # end instead of growing a string one character at a time:
+  bits = []
+  i = idx + 1
+  while True:
+    end = src.find(qc, i)
+    if end < 0:
+      break
+    esc = src.find('\\', i, end)
+    if esc < 0:
+      bits.append(src[i:end])
+      return (end, ''.join(bits))
+    bits.append(src[i:esc])
+    c = src[esc+1] # exists since esc < end
+    if c == qc:
+      bits.append(qc)
+    else: # unrecognized escape codes are kept as-is
+      bits.append(STRING_ESCAPES.get(c, '\\' + c))
+    i = esc + 2
   # need to hit return inside of loop, otherwise we've run out of source
   # material without finding a matching quote.
   raise UnmatchedError(
@@ -233,21 +256,19 @@ def find_quoted_regions(text, qc='"'):
         ((23, 30), 'fi"ve')
       ]
     )
+    ```?
+    find_quoted_regions('"a""b"', qc='"')
+    ```=
+    collections.OrderedDict([((0, 2), "a"), ((3, 5), "b")])
     ```
   """
-  escaped = False
-  result = []
-
-  # First, find all quoted regions:
   quoted_regions = collections.OrderedDict()
-  i = -1
-  while i < len(text) - 1:
-    i += 1
-    c = text[i]
-    if c == qc:
-      ei, qcont = string_literal(text, i, qc=qc)
-      quoted_regions[(i, ei)] = qcont
-      i = ei + 1 # skip ahead
+  # Jump from quote to quote instead of stepping through every character:
+  i = text.find(qc)
+  while i >= 0:
+    ei, qcont = string_literal(text, i, qc=qc)
+    quoted_regions[(i, ei)] = qcont
+    i = text.find(qc, ei + 1)
 
   return quoted_regions
 